@@ -0,0 +1,283 @@
+"""
+Attendance Write-Behind Queue
+
+When ATTENDANCE_WRITE_BEHIND=1 and REDIS_URL is set, /attendance/mark pushes each
+validated batch onto a Redis Stream and returns 202 immediately. This worker drains
+the stream into MongoDB, accumulating entries for up to ATTENDANCE_BATCH_MS or
+ATTENDANCE_BATCH_DOCS records per insert_many, then invalidates the cached summaries
+of the affected rolls. Entries left pending by a dead worker are taken over with
+XAUTOCLAIM after ATTENDANCE_CLAIM_IDLE_MS.
+
+A batch is acknowledged only after it has been written. Each record carries a
+queue_key derived from the batch ID the API assigned, backed by a unique index, so
+replaying a batch never inserts a record twice. Entries that cannot be decoded are
+moved to the attendance:writes:dead stream rather than retried forever.
+
+Run one or more workers alongside the API:
+    python attendance_queue.py
+"""
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import date, datetime, time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import orjson
+import pymongo
+import redis.asyncio as redis
+from pymongo.errors import BulkWriteError, PyMongoError
+from redis.exceptions import RedisError, ResponseError
+
+from cache import cache, close_cache, invalidate, redis_url, summary_key
+from database import db, close_client, INDEX_BUILD_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+STREAM = "attendance:writes"
+GROUP = "attendance-writers"
+# Malformed entries are moved here (with a source_id field) for inspection instead of blocking the queue
+DEAD_LETTER_STREAM = f"{STREAM}:dead"
+DUPLICATE_KEY = 11000
+# A batch is flushed once it holds BATCH_MAX_DOCS records or BATCH_WINDOW_MS after its first entry;
+# no single insert_many ever carries more than BATCH_MAX_DOCS records
+BATCH_MAX_DOCS = int(os.getenv("ATTENDANCE_BATCH_DOCS", 1000))
+BATCH_WINDOW_MS = int(os.getenv("ATTENDANCE_BATCH_MS", 500))
+# Stream entries fetched per XREADGROUP/XAUTOCLAIM; each entry is a whole class, so keep it small
+READ_PAGE_ENTRIES = 10
+# Entries left pending this long by a dead consumer are claimed by a live one
+CLAIM_IDLE_MS = int(os.getenv("ATTENDANCE_CLAIM_IDLE_MS", 60000))
+# How long an idle worker waits for new entries before checking for stale ones
+IDLE_BLOCK_MS = 5000
+
+write_behind_enabled = cache is not None and os.getenv("ATTENDANCE_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+
+
+def build_attendance_docs(
+    day: date, entries: Iterable[Sequence[str]], now: datetime, batch_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Build attendancerecord documents from (roll, status) pairs"""
+    # BSON has no date-only type; store midnight of the attendance day
+    attendance_date = datetime.combine(day, time.min)
+    docs = [
+        {
+            "roll": roll,
+            "status": status,
+            "attendance_date": attendance_date,
+            "marked_by_role": "teacher",
+            "created_at": now,
+            "updated_at": now,
+        }
+        for roll, status in entries
+    ]
+    if batch_id:
+        # Deterministic per-record key so writing the same batch twice hits the unique index instead of duplicating
+        for i, doc in enumerate(docs):
+            doc["queue_key"] = f"{batch_id}:{i}"
+    return docs
+
+
+def only_duplicates(e: BulkWriteError) -> bool:
+    """True when every failed write was a duplicate queue_key, i.e. already written"""
+    return not e.details.get("writeConcernErrors") and all(
+        err.get("code") == DUPLICATE_KEY for err in e.details.get("writeErrors", [])
+    )
+
+
+async def enqueue_marks(day: date, entries: List[Tuple[str, str]], now: datetime, batch_id: str):
+    """Append one marked batch to the stream"""
+    payload = {"batch_id": batch_id, "date": day, "ts": now, "entries": entries}
+    await cache.xadd(STREAM, {"payload": orjson.dumps(payload)})
+
+
+def _str_id(msg_id: Any) -> str:
+    return msg_id.decode() if isinstance(msg_id, bytes) else str(msg_id)
+
+
+# (stream entry ID, records to write); trimmed entries carry no records but still get acknowledged
+Entry = Tuple[str, List[Dict[str, Any]]]
+
+
+def _decode(msg_id: str, fields: Dict[bytes, bytes]) -> List[Dict[str, Any]]:
+    batch = orjson.loads(fields[b"payload"])
+    for roll, status in batch["entries"]:
+        if not isinstance(roll, str) or status not in ("present", "absent"):
+            raise ValueError(f"invalid entry {roll!r}: {status!r}")
+    return build_attendance_docs(
+        date.fromisoformat(batch["date"]),
+        batch["entries"],
+        datetime.fromisoformat(batch["ts"]),
+        batch.get("batch_id") or msg_id,
+    )
+
+
+async def _parse(stream: redis.Redis, messages: List[Tuple[Any, Optional[Dict[bytes, bytes]]]]) -> List[Entry]:
+    """Decode raw stream entries one by one; malformed ones are dead-lettered instead of returned"""
+    entries = []
+    for raw_id, fields in messages:
+        msg_id = _str_id(raw_id)
+        # Pending entries whose data was trimmed come back without fields; nothing to write
+        if not fields:
+            logger.warning("Stream entry %s has no data (trimmed); acknowledging without writing", msg_id)
+            entries.append((msg_id, []))
+            continue
+        try:
+            entries.append((msg_id, _decode(msg_id, fields)))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Retrying can never succeed, and leaving it pending would block every worker that claims it
+            logger.exception("Stream entry %s is malformed; moving it to %s", msg_id, DEAD_LETTER_STREAM)
+            async with stream.pipeline(transaction=True) as pipe:
+                pipe.xadd(DEAD_LETTER_STREAM, {**fields, b"source_id": msg_id})
+                pipe.xack(STREAM, GROUP, msg_id)
+                pipe.xdel(STREAM, msg_id)
+                await pipe.execute()
+    return entries
+
+
+async def _flush(stream: redis.Redis, entries: List[Entry]):
+    docs = [doc for _, records in entries for doc in records]
+    # Page reads can overshoot the cap by part of a page, so chunk the inserts to honour it exactly
+    for i in range(0, len(docs), BATCH_MAX_DOCS):
+        try:
+            await db.attendancerecord.insert_many(docs[i:i + BATCH_MAX_DOCS], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate queue_keys were written by an earlier attempt (or by the API's fallback path)
+            if not only_duplicates(e):
+                raise
+    await invalidate(*{summary_key(doc["roll"]) for doc in docs})
+    # XACK only clears the pending list; XDEL frees the written entries from the stream too
+    ids = [msg_id for msg_id, _ in entries]
+    if not ids:
+        return
+    async with stream.pipeline(transaction=True) as pipe:
+        pipe.xack(STREAM, GROUP, *ids)
+        pipe.xdel(STREAM, *ids)
+        await pipe.execute()
+
+
+async def _replay_pending(stream: redis.Redis, consumer: str):
+    """Write everything already delivered to this consumer but never acknowledged"""
+    entries = []
+    n_docs = 0
+    last_id = "0"
+    while True:
+        # An explicit ID pages through this consumer's pending entries after last_id
+        resp = await stream.xreadgroup(GROUP, consumer, {STREAM: last_id}, count=READ_PAGE_ENTRIES)
+        messages = resp[0][1] if resp else []
+        if not messages:
+            break
+        last_id = _str_id(messages[-1][0])
+        for msg_id, records in await _parse(stream, messages):
+            entries.append((msg_id, records))
+            n_docs += len(records)
+        if n_docs >= BATCH_MAX_DOCS:
+            await _flush(stream, entries)
+            entries, n_docs = [], 0
+    if entries:
+        await _flush(stream, entries)
+
+
+async def _claim_stale(stream: redis.Redis, consumer: str):
+    """Take over and write entries another consumer read but never acknowledged"""
+    entries = []
+    n_docs = 0
+    start_id = "0-0"
+    while True:
+        resp = await stream.xautoclaim(
+            STREAM, GROUP, consumer, CLAIM_IDLE_MS, start_id=start_id, count=READ_PAGE_ENTRIES
+        )
+        start_id, messages = resp[0], resp[1]
+        if messages:
+            logger.info("Claimed %d stale stream entries", len(messages))
+            for msg_id, records in await _parse(stream, messages):
+                entries.append((msg_id, records))
+                n_docs += len(records)
+        if n_docs >= BATCH_MAX_DOCS:
+            await _flush(stream, entries)
+            entries, n_docs = [], 0
+        if _str_id(start_id) == "0-0":
+            break
+    if entries:
+        await _flush(stream, entries)
+
+
+async def _collect(stream: redis.Redis, consumer: str) -> List[Entry]:
+    """Wait for new entries, then keep reading until the batch is full or its window closes"""
+    loop = asyncio.get_running_loop()
+    entries = []
+    n_docs = 0
+    deadline = None
+    while n_docs < BATCH_MAX_DOCS:
+        if deadline is None:
+            block = IDLE_BLOCK_MS
+        else:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            block = max(1, int(remaining * 1000))
+        resp = await stream.xreadgroup(GROUP, consumer, {STREAM: ">"}, count=READ_PAGE_ENTRIES, block=block)
+        messages = resp[0][1] if resp else []
+        if not messages:
+            break
+        if deadline is None:
+            deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        for msg_id, records in await _parse(stream, messages):
+            entries.append((msg_id, records))
+            n_docs += len(records)
+    return entries
+
+
+async def drain(stream: redis.Redis, consumer: str):
+    """Read the stream forever, writing accumulated batches with one insert_many each"""
+    try:
+        await stream.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    # Required for idempotent replays, so unlike ensure_indexes() a failure here is fatal.
+    # The build scans all of attendancerecord; pymongo.timeout() lifts socketTimeoutMS for it.
+    with pymongo.timeout(INDEX_BUILD_TIMEOUT_SECONDS):
+        await db.attendancerecord.create_index(
+            "queue_key",
+            unique=True,
+            partialFilterExpression={"queue_key": {"$exists": True}},
+        )
+
+    loop = asyncio.get_running_loop()
+    recover = True
+    next_claim = 0.0
+    while True:
+        try:
+            if recover:
+                await _replay_pending(stream, consumer)
+                recover = False
+            if loop.time() >= next_claim:
+                await _claim_stale(stream, consumer)
+                next_claim = loop.time() + CLAIM_IDLE_MS / 1000
+            entries = await _collect(stream, consumer)
+            if entries:
+                await _flush(stream, entries)
+        except (PyMongoError, RedisError):
+            # Unacknowledged entries stay pending; replay them once the backend is back
+            logger.exception("Write-behind flush failed; retrying")
+            recover = True
+            await asyncio.sleep(1)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    if cache is None or db is None:
+        raise SystemExit("REDIS_URL, DATABASE_URL and DATABASE_NAME must be set")
+    # Dedicated client without the API's short socket_timeout, which blocking XREADGROUP would trip
+    stream = redis.Redis.from_url(redis_url, socket_connect_timeout=5)
+    try:
+        await drain(stream, os.getenv("ATTENDANCE_CONSUMER", socket.gethostname()))
+    finally:
+        await stream.aclose()
+        close_client()
+        await close_cache()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Cache Helper Functions
+
+Two-tier cache for read-heavy endpoints: a small in-process TTL cache (L1) in front
+of Redis (L2). Caching is optional: when REDIS_URL is not set every helper is a
+no-op/miss. L1 is only used alongside Redis, whose pub/sub fans evictions out to
+the other workers.
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Optional
+
+import redis.asyncio as redis
+from cachetools import TTLCache
+from redis.exceptions import RedisError
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+CACHE_PREFIX = "campus"
+SUMMARY_TTL_SECONDS = 60
+L1_TTL_SECONDS = 10
+INVALIDATION_CHANNEL = f"{CACHE_PREFIX}:invalidate"
+
+cache = None
+
+# Per-process L1; short TTL bounds staleness if an eviction broadcast is missed
+_l1 = TTLCache(maxsize=1024, ttl=L1_TTL_SECONDS)
+
+redis_url = os.getenv("REDIS_URL")
+
+# Initialize client defensively so a missing/invalid Redis URI doesn't crash the app
+if redis_url:
+    try:
+        # Short timeouts so an unreachable Redis turns into a fast miss, not a hung request
+        cache = redis.Redis.from_url(redis_url, socket_connect_timeout=0.2, socket_timeout=0.5)
+    except Exception:
+        cache = None
+
+
+def summary_key(roll: str) -> str:
+    """Cache key for a student's attendance summary"""
+    return f"{CACHE_PREFIX}:sum:{roll}"
+
+
+async def get_cached(key: str) -> Optional[Any]:
+    """Return the cached value from L1, then Redis, or None on miss"""
+    if cache is None:
+        return None
+    value = _l1.get(key)
+    if value is not None:
+        return value
+    try:
+        raw = await cache.get(key)
+    except RedisError:
+        return None
+    if raw is None:
+        return None
+    value = _l1[key] = json.loads(raw)
+    return value
+
+
+async def set_cached(key: str, value: Any, ttl: int):
+    """Store a JSON-serializable value in both tiers"""
+    if cache is None:
+        return
+    _l1[key] = value
+    try:
+        await cache.set(key, json.dumps(value), ex=ttl)
+    except RedisError:
+        pass
+
+
+async def invalidate(*keys: str):
+    """Drop keys from L1 and Redis, and tell other workers to drop them from their L1"""
+    if cache is None or not keys:
+        return
+    for key in keys:
+        _l1.pop(key, None)
+    try:
+        # DEL + PUBLISH in a single round-trip
+        async with cache.pipeline(transaction=False) as pipe:
+            pipe.delete(*keys)
+            pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+            await pipe.execute()
+    except RedisError:
+        pass
+
+
+async def listen_invalidations():
+    """Apply other workers' evictions to this process's L1 (run as a background task)"""
+    if cache is None:
+        return
+    # Own client: the shared one's short socket_timeout would keep interrupting the blocking listen
+    subscriber = redis.Redis.from_url(redis_url, socket_connect_timeout=0.2)
+    try:
+        while True:
+            try:
+                pubsub = subscriber.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                try:
+                    async for message in pubsub.listen():
+                        for key in json.loads(message["data"]):
+                            _l1.pop(key, None)
+                finally:
+                    await pubsub.aclose()
+            except RedisError:
+                # Entries missed while disconnected still expire within L1_TTL_SECONDS
+                await asyncio.sleep(1)
+    finally:
+        await subscriber.aclose()
+
+
+async def close_cache():
+    """Close the shared Redis connection pool (call on application shutdown)"""
+    if cache is not None:
+        await cache.aclose()
@@ -1,12 +1,15 @@
 """
 Database Helper Functions
 
-MongoDB helper functions ready to use in your backend code.
-Import and use these functions in your API endpoints for database operations.
+Async MongoDB (Motor) helper functions ready to use in your backend code.
+Import and await these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+import pymongo
+from pymongo import ASCENDING, DESCENDING
 from datetime import datetime, timezone
+import logging
 import os
 from dotenv import load_dotenv
 from typing import Union
@@ -15,16 +18,43 @@ from pydantic import BaseModel
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Index builds on large collections can run far longer than socketTimeoutMS
+INDEX_BUILD_TIMEOUT_SECONDS = int(os.getenv("MONGO_INDEX_BUILD_TIMEOUT", 600))
+
+# (collection, keys, options) for every index the API queries rely on
+INDEXES = [
+    ("attendancerecord", [("roll", ASCENDING), ("status", ASCENDING)], {}),
+    ("attendancerecord", [("attendance_date", DESCENDING), ("_id", DESCENDING)], {}),
+    ("attendanceoverride", "roll", {"unique": True}),
+    ("campususer", "email", {"unique": True}),
+    ("event", [("date", ASCENDING), ("_id", ASCENDING)], {}),
+    # Dedupes write-behind records (see attendance_queue); the worker also creates it on start
+    ("attendancerecord", "queue_key", {"unique": True, "partialFilterExpression": {"queue_key": {"$exists": True}}}),
+]
+
 _client = None
 db = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
-# Initialize client defensively so missing/invalid Mongo URIs don't crash the app
+# Initialize client defensively so missing/invalid Mongo URIs don't crash the app.
+# Motor binds to the running event loop lazily, so one client per process is shared by all requests.
 if database_url and database_name:
     try:
-        _client = MongoClient(database_url)
+        _client = AsyncIOMotorClient(
+            database_url,
+            maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 200)),
+            minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 20)),
+            waitQueueTimeoutMS=2000,
+            serverSelectionTimeoutMS=3000,
+            socketTimeoutMS=10000,
+            retryWrites=True,
+            # Drivers negotiate the first compressor the server also supports
+            compressors="zstd,zlib",
+        )
         db = _client[database_name]
     except Exception:
         # Leave db as None; API endpoints should handle this gracefully
@@ -32,7 +62,7 @@ if database_url and database_name:
 
 # Helper functions for common database operations
 
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -43,14 +73,15 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -59,4 +90,25 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
 
-    return list(cursor)
+    return await cursor.to_list(length=limit)
+
+
+async def ensure_indexes():
+    """Create the indexes the API queries rely on (idempotent, safe on every boot)"""
+    if db is None:
+        return
+
+    # pymongo.timeout() overrides socketTimeoutMS for the blocking createIndexes calls
+    with pymongo.timeout(INDEX_BUILD_TIMEOUT_SECONDS):
+        for collection, keys, options in INDEXES:
+            # One failure (e.g. duplicates blocking a unique index) must not skip the rest
+            try:
+                await db[collection].create_index(keys, **options)
+            except Exception:
+                logger.exception("Could not create index %s %s on %s", keys, options, collection)
+
+
+def close_client():
+    """Close the shared client (call on application shutdown)"""
+    if _client is not None:
+        _client.close()
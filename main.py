@@ -1,17 +1,53 @@
+import asyncio
 import os
-from datetime import datetime, date
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timezone
 from typing import List, Optional, Literal, Any, Dict
 
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, EmailStr, Field
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from redis.exceptions import RedisError
 
-from database import db, create_document, get_documents
+from database import db, ensure_indexes, close_client
+from cache import summary_key, get_cached, set_cached, invalidate, listen_invalidations, close_cache, SUMMARY_TTL_SECONDS
+from attendance_queue import build_attendance_docs, enqueue_marks, only_duplicates, write_behind_enabled
 from schemas import CampusUser, Event, AttendanceRecord, AttendanceOverride
 
 
-app = FastAPI(title="Campus Portal API")
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson-encoded response that also understands ObjectId"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Index builds can be slow on large collections, so don't hold up startup for them;
+    # ensure_indexes logs its own failures and queries still work unindexed meanwhile
+    indexer = asyncio.create_task(ensure_indexes())
+    listener = asyncio.create_task(listen_invalidations())
+    yield
+    indexer.cancel()
+    listener.cancel()
+    close_client()
+    await close_cache()
+
+
+app = FastAPI(title="Campus Portal API", lifespan=lifespan, default_response_class=MongoJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,6 +55,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -27,23 +64,71 @@ app.add_middleware(
 # -----------------------------
 
 def serialize_id(doc: Dict[str, Any]) -> Dict[str, Any]:
-    if not doc:
-        return doc
-    d = dict(doc)
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    # Convert datetime/date to isoformat for JSON safety
-    for k, v in list(d.items()):
-        if isinstance(v, (datetime, date)):
-            d[k] = v.isoformat()
-    return d
+    """Rename _id to a string id in place; dates are left for the JSON encoder"""
+    if doc and "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+def as_stored(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize datetimes in place to what Mongo returns: naive UTC at millisecond precision"""
+    for k, v in doc.items():
+        if isinstance(v, datetime):
+            if v.tzinfo is not None:
+                v = v.astimezone(timezone.utc).replace(tzinfo=None)
+            doc[k] = v.replace(microsecond=v.microsecond // 1000 * 1000)
+    return doc
+
+
+async def upsert_one(collection, query: Dict[str, Any], update: Dict[str, Any], conflict_detail: str) -> Dict[str, Any]:
+    """find_one_and_update(upsert=True) keyed on a unique index, returning the new document"""
+    # A concurrent upsert can win the insert race on the unique key; the retry then matches its doc
+    for attempt in range(2):
+        try:
+            return await collection.find_one_and_update(
+                query, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            if attempt:
+                raise HTTPException(status_code=409, detail=conflict_detail)
 
 
 def oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
+    if not ObjectId.is_valid(id_str):
         raise HTTPException(status_code=400, detail="Invalid ID format")
+    return ObjectId(id_str)
+
+
+def list_response(docs: List[Dict[str, Any]], cursor: Optional[str]) -> MongoJSONResponse:
+    """Encode a page of documents straight to JSON, skipping FastAPI's per-field jsonable_encoder pass"""
+    headers = {"X-Next-Cursor": cursor} if cursor else None
+    return MongoJSONResponse([serialize_id(d) for d in docs], headers=headers)
+
+
+def attendance_percentage(present: int, absent: int) -> float:
+    total = present + absent
+    return present * 100.0 / total if total else 0.0
+
+
+def keyset_filter(field: str, after: Optional[str], direction: int) -> Dict[str, Any]:
+    """Range filter resuming a (field, _id) sort right after the given page cursor"""
+    if not after:
+        return {}
+    value, _, last_id = after.rpartition("_")
+    try:
+        value = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    op = "$gt" if direction > 0 else "$lt"
+    return {"$or": [{field: {op: value}}, {field: value, "_id": {op: oid(last_id)}}]}
+
+
+def next_cursor(docs: List[Dict[str, Any]], field: str, limit: int) -> Optional[str]:
+    """Cursor for the page after docs, or None when this was the last page"""
+    if len(docs) < limit:
+        return None
+    last = docs[-1]
+    return f"{last[field].isoformat()}_{last['_id']}"
 
 
 # -----------------------------
@@ -51,12 +136,12 @@ def oid(id_str: str) -> ObjectId:
 # -----------------------------
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Campus Portal API running"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     """Test endpoint to check if database is available and accessible"""
     response = {
         "backend": "✅ Running",
@@ -74,7 +159,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -96,15 +181,19 @@ class SchemaField(BaseModel):
     description: Optional[str] = None
 
 
+# Models are static, so their JSON schemas are built once at import time
+_SCHEMA_CACHE = {
+    "campususer": CampusUser.model_json_schema(),
+    "event": Event.model_json_schema(),
+    "attendancerecord": AttendanceRecord.model_json_schema(),
+    "attendanceoverride": AttendanceOverride.model_json_schema(),
+}
+
+
 @app.get("/schema")
-def get_schema():
+async def get_schema():
     """Expose basic schema info for viewer/tools"""
-    return {
-        "campususer": CampusUser.model_json_schema(),
-        "event": Event.model_json_schema(),
-        "attendancerecord": AttendanceRecord.model_json_schema(),
-        "attendanceoverride": AttendanceOverride.model_json_schema(),
-    }
+    return _SCHEMA_CACHE
 
 
 # -----------------------------
@@ -120,24 +209,22 @@ class DemoLoginRequest(BaseModel):
 
 
 @app.post("/auth/demo-login")
-def demo_login(payload: DemoLoginRequest):
+async def demo_login(payload: DemoLoginRequest):
     """
     Demo login: upsert user by email and return user record.
     """
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    existing = db.campususer.find_one({"email": payload.email})
     data = payload.model_dump()
-    data["updated_at"] = datetime.utcnow()
-
-    if existing:
-        db.campususer.update_one({"_id": existing["_id"]}, {"$set": data})
-        user = db.campususer.find_one({"_id": existing["_id"]})
-    else:
-        user_id = create_document("campususer", CampusUser(**data))
-        user = db.campususer.find_one({"_id": ObjectId(user_id)})
-
+    now = datetime.now(timezone.utc)
+    data["updated_at"] = now
+    user = await upsert_one(
+        db.campususer,
+        {"email": payload.email},
+        {"$set": data, "$setOnInsert": {"created_at": now}},
+        "Email already in use",
+    )
     return serialize_id(user)
 
 
@@ -153,17 +240,24 @@ class UpdateUserRequest(BaseModel):
 
 
 @app.put("/users/{user_id}")
-def update_user(user_id: str, payload: UpdateUserRequest):
+async def update_user(user_id: str, payload: UpdateUserRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     updates = {k: v for k, v in payload.model_dump(exclude_none=True).items()}
     if not updates:
         return {"updated": False}
-    updates["updated_at"] = datetime.utcnow()
-    result = db.campususer.update_one({"_id": oid(user_id)}, {"$set": updates})
-    if result.matched_count == 0:
+    updates["updated_at"] = datetime.now(timezone.utc)
+    try:
+        doc = await db.campususer.find_one_and_update(
+            {"_id": oid(user_id)},
+            {"$set": updates},
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # campususer.email is unique
+        raise HTTPException(status_code=409, detail="Email already in use")
+    if doc is None:
         raise HTTPException(status_code=404, detail="User not found")
-    doc = db.campususer.find_one({"_id": oid(user_id)})
     return serialize_id(doc)
 
 
@@ -179,31 +273,52 @@ class EventCreateRequest(BaseModel):
     created_by_role: Literal["teacher", "student"] = "teacher"
 
 
+# Fields the list views render; everything else stays on the server
+EVENT_LIST_FIELDS = {"title": 1, "description": 1, "date": 1, "location": 1, "created_by_role": 1}
+
+
 @app.get("/events")
-def list_events(limit: int = Query(100, ge=1, le=500)):
-    docs = db.event.find({}).sort("date", 1).limit(limit)
-    return [serialize_id(d) for d in docs]
+async def list_events(
+    limit: int = Query(100, ge=1, le=500),
+    after: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+):
+    cursor = (
+        db.event.find(keyset_filter("date", after, 1), EVENT_LIST_FIELDS)
+        .sort([("date", 1), ("_id", 1)])
+        .batch_size(limit)
+        .limit(limit)
+    )
+    docs = await cursor.to_list(length=limit)
+    return list_response(docs, next_cursor(docs, "date", limit))
 
 
 @app.post("/events")
-def create_event(payload: EventCreateRequest):
-    event_id = create_document("event", Event(**payload.model_dump()))
-    doc = db.event.find_one({"_id": ObjectId(event_id)})
-    return serialize_id(doc)
+async def create_event(payload: EventCreateRequest):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    doc = payload.model_dump()
+    doc["created_at"] = datetime.now(timezone.utc)
+    doc["updated_at"] = doc["created_at"]
+    # insert_one sets doc["_id"] in place, so the inserted document can be returned without re-reading it
+    await db.event.insert_one(doc)
+    return serialize_id(as_stored(doc))
 
 
 @app.put("/events/{event_id}")
-def update_event(event_id: str, payload: EventCreateRequest):
-    result = db.event.update_one({"_id": oid(event_id)}, {"$set": payload.model_dump()})
-    if result.matched_count == 0:
+async def update_event(event_id: str, payload: EventCreateRequest):
+    doc = await db.event.find_one_and_update(
+        {"_id": oid(event_id)},
+        {"$set": payload.model_dump()},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
         raise HTTPException(status_code=404, detail="Event not found")
-    doc = db.event.find_one({"_id": oid(event_id)})
     return serialize_id(doc)
 
 
 @app.delete("/events/{event_id}")
-def delete_event(event_id: str):
-    result = db.event.delete_one({"_id": oid(event_id)})
+async def delete_event(event_id: str):
+    result = await db.event.delete_one({"_id": oid(event_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Event not found")
     return {"deleted": True}
@@ -224,56 +339,115 @@ class AttendanceMarkRequest(BaseModel):
 
 
 @app.post("/attendance/mark")
-def mark_attendance(payload: AttendanceMarkRequest):
+async def mark_attendance(payload: AttendanceMarkRequest, background_tasks: BackgroundTasks):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
     if not payload.entries:
         raise HTTPException(status_code=400, detail="No entries to mark")
-    inserted_ids = []
-    for e in payload.entries:
-        doc = AttendanceRecord(roll=e.roll, status=e.status, attendance_date=payload.date, marked_by_role="teacher")
-        ins_id = create_document("attendancerecord", doc)
-        inserted_ids.append(ins_id)
+    now = datetime.now(timezone.utc)
+    entries = [(e.roll, e.status) for e in payload.entries]
+    batch_id = None
+    if write_behind_enabled:
+        # The attendance_queue worker writes the batch and invalidates summaries
+        batch_id = uuid.uuid4().hex
+        try:
+            await enqueue_marks(payload.date, entries, now, batch_id)
+            return MongoJSONResponse({"queued": len(entries)}, status_code=202)
+        except RedisError:
+            # Redis is down or slow; write synchronously rather than failing the request.
+            # The XADD may still have landed, so stamp the same batch_id and let the
+            # unique queue_key index keep the worker from writing the batch a second time.
+            pass
+    # Entries were already validated by AttendanceMarkRequest, so build the records directly
+    docs = build_attendance_docs(payload.date, entries, now, batch_id)
+    # One insert_many instead of a round-trip per entry; unordered so one bad doc doesn't abort the batch
+    try:
+        result = await db.attendancerecord.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if not (batch_id and only_duplicates(e)):
+            raise
+        # The enqueue did land and the worker already wrote (and will invalidate) this batch
+        return MongoJSONResponse({"queued": len(entries)}, status_code=202)
+    inserted_ids = [str(i) for i in result.inserted_ids]
+    # One multi-key DEL for every affected roll, sent after the response goes out
+    background_tasks.add_task(invalidate, *{summary_key(e.roll) for e in payload.entries})
     return {"inserted": len(inserted_ids), "ids": inserted_ids}
 
 
+ATTENDANCE_LIST_FIELDS = {"roll": 1, "status": 1, "attendance_date": 1}
+
+
 @app.get("/attendance/recent")
-def recent_attendance(limit: int = Query(20, ge=1, le=200)):
-    docs = db.attendancerecord.find({}).sort("attendance_date", -1).limit(limit)
-    return [serialize_id(d) for d in docs]
+async def recent_attendance(
+    limit: int = Query(20, ge=1, le=200),
+    after: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+):
+    cursor = (
+        db.attendancerecord.find(keyset_filter("attendance_date", after, -1), ATTENDANCE_LIST_FIELDS)
+        .sort([("attendance_date", -1), ("_id", -1)])
+        .batch_size(limit)
+        .limit(limit)
+    )
+    docs = await cursor.to_list(length=limit)
+    return list_response(docs, next_cursor(docs, "attendance_date", limit))
 
 
 class ManualPercentageRequest(BaseModel):
     roll: str
-    manual_percentage: float
+    manual_percentage: float = Field(..., ge=0, le=100)
 
 
 @app.post("/attendance/manual-percentage")
-def set_manual_percentage(payload: ManualPercentageRequest):
-    existing = db.attendanceoverride.find_one({"roll": payload.roll})
-    if existing:
-        db.attendanceoverride.update_one({"_id": existing["_id"]}, {"$set": payload.model_dump()})
-        doc = db.attendanceoverride.find_one({"_id": existing["_id"]})
-    else:
-        ins_id = create_document("attendanceoverride", AttendanceOverride(**payload.model_dump()))
-        doc = db.attendanceoverride.find_one({"_id": ObjectId(ins_id)})
+async def set_manual_percentage(payload: ManualPercentageRequest):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    data = payload.model_dump()
+    now = datetime.now(timezone.utc)
+    data["updated_at"] = now
+    doc = await upsert_one(
+        db.attendanceoverride,
+        {"roll": payload.roll},
+        {"$set": data, "$setOnInsert": {"created_at": now}},
+        "Override for this roll already exists",
+    )
+    await invalidate(summary_key(payload.roll))
     return serialize_id(doc)
 
 
 @app.get("/attendance/summary")
-def attendance_summary(roll: str = Query(..., description="Student roll number")):
+async def attendance_summary(roll: str = Query(..., description="Student roll number")):
     """Compute present/absent counts and percentage, honoring manual override if set."""
-    total_present = db.attendancerecord.count_documents({"roll": roll, "status": "present"})
-    total_absent = db.attendancerecord.count_documents({"roll": roll, "status": "absent"})
-    total = total_present + total_absent
-    percentage = (total_present / total * 100.0) if total > 0 else 0.0
-    override = db.attendanceoverride.find_one({"roll": roll})
+    key = summary_key(roll)
+    cached = await get_cached(key)
+    if cached is not None:
+        return cached
+    # Status counts plus the override row ({_id: "override"}) in a single round-trip
+    pipeline = [
+        {"$match": {"roll": roll}},
+        {"$group": {"_id": "$status", "n": {"$sum": 1}}},
+        {"$unionWith": {
+            "coll": "attendanceoverride",
+            "pipeline": [
+                {"$match": {"roll": roll}},
+                {"$project": {"_id": {"$literal": "override"}, "manual_percentage": 1}},
+            ],
+        }},
+    ]
+    rows = {d["_id"]: d async for d in db.attendancerecord.aggregate(pipeline)}
+    total_present = rows.get("present", {}).get("n", 0)
+    total_absent = rows.get("absent", {}).get("n", 0)
+    percentage = attendance_percentage(total_present, total_absent)
+    override = rows.get("override")
     if override and isinstance(override.get("manual_percentage"), (int, float)):
         percentage = float(override["manual_percentage"])
-    return {
+    summary = {
         "roll": roll,
         "presentDays": total_present,
         "absentDays": total_absent,
         "percentage": round(percentage, 2)
     }
+    await set_cached(key, summary, SUMMARY_TTL_SECONDS)
+    return summary
 
 
 if __name__ == "__main__":